@@ -162,7 +162,7 @@ local function mcp_request(endpoint, opts)
   -- Prepare request to /explain or /fix
   local payload = vim.fn.json_encode { session_id = session_id, snippet = code, programming_lang = detect_language() }
   local url = config.base_url .. endpoint
-  local resp = vim.fn.systemlist(string.format('curl -s -X POST %s -H "Content-Type: application/json" -d %q', url, payload))
+  local resp = vim.fn.systemlist(string.format('curl -s --compressed -X POST %s -H "Content-Type: application/json" -d %q', url, payload))
 
   stop_spinner()
 
@@ -1,24 +1,46 @@
 import os
-import uuid
+import secrets
+import asyncio
+import hashlib
 import logging
+import time
+from pathlib import Path
 from fastapi import FastAPI, HTTPException, Request
 from pydantic import BaseModel
 from fastapi.middleware.cors import CORSMiddleware
-import requests
+from fastapi.middleware.gzip import GZipMiddleware
+from fastapi.responses import ORJSONResponse, Response, StreamingResponse
+import httpx
+import orjson
+import redis.asyncio as aioredis
+from redis.exceptions import LockError
+from cachetools import TTLCache
+from tenacity import AsyncRetrying, retry_if_exception, stop_after_attempt, wait_exponential_jitter
 from dotenv import load_dotenv
 
 # --- Load environment variables ---
 load_dotenv()
 GEMINI_API_URL = "https://generativelanguage.googleapis.com/v1beta/models/gemini-2.5-flash:generateContent"
+GEMINI_STREAM_URL = "https://generativelanguage.googleapis.com/v1beta/models/gemini-2.5-flash:streamGenerateContent?alt=sse"
 API_KEY = os.getenv("GEMINI_API_KEY")
 if not API_KEY:
     raise ValueError("GEMINI_API_KEY environment variable not set!")
 
+# Parsed/built once rather than on every Gemini call
+GEMINI_URL = httpx.URL(GEMINI_API_URL)
+GEMINI_STREAM = httpx.URL(GEMINI_STREAM_URL)
+HEADERS = {
+    "x-goog-api-key": API_KEY,
+    "Content-Type": "application/json"
+}
+REDIS_URL = os.getenv("REDIS_URL", "redis://localhost:6379/0")
+
 # --- Logging setup ---
 logging.basicConfig(level=logging.INFO, format="%(asctime)s [%(levelname)s] %(message)s")
+log = logging.getLogger(__name__)
 
 # --- FastAPI setup ---
-app = FastAPI(title="Full-File MCP Server")
+app = FastAPI(title="Full-File MCP Server", default_response_class=ORJSONResponse)
 app.add_middleware(
     CORSMiddleware,
     allow_origins=["*"],
@@ -26,14 +48,68 @@ app.add_middleware(
     allow_headers=["*"],
 )
 
-# --- In-memory session storage ---
-sessions = {}
+# SSE endpoints must not go through gzip: depending on the Starlette version
+# the compressor buffers streamed frames until the response ends
+STREAM_PATHS = {"/explain_stream"}
+
+class NonStreamingGZipMiddleware(GZipMiddleware):
+    async def __call__(self, scope, receive, send):
+        if scope["type"] == "http" and scope["path"] in STREAM_PATHS:
+            await self.app(scope, receive, send)
+            return
+        await super().__call__(scope, receive, send)
+
+app.add_middleware(NonStreamingGZipMiddleware, minimum_size=1024)
+
+# --- Shared HTTP client for Gemini ---
+# One long-lived HTTP/2 client so every call reuses a pooled connection
+# instead of paying a TCP+TLS handshake (requires `httpx[http2]`).
+def gemini_timeout(read: float = 60.0):
+    # httpx replaces (not merges) the client timeout per request, so call
+    # sites pass a full Timeout that only varies the read budget
+    return httpx.Timeout(read, connect=5.0, write=10.0, pool=5.0)
+
+client = httpx.AsyncClient(
+    http2=True,
+    timeout=gemini_timeout(),
+    limits=httpx.Limits(max_keepalive_connections=32, max_connections=64, keepalive_expiry=60.0),
+)
+
+@app.on_event("shutdown")
+async def close_client():
+    await client.aclose()
+
+# --- Redis session storage ---
+# Sessions live in Redis so every uvicorn worker sees the same state:
+#   session:{id}          hash  (file_name, full_file)
+#   session:{id}:history  list  (JSON-encoded Gemini turns: {"role": "user"|"model", "parts": [...]})
+#   session:{id}:assistant list (assistant replies only, for /get_full_explanation)
+#   sessions              zset  (session ids scored by last use)
+# The per-session keys expire after SESSION_TTL seconds without use, and the
+# least recently used sessions are deleted once there are MAX_SESSIONS.
+SESSION_TTL = 86400
+SESSION_INDEX = "sessions"
+MAX_SESSIONS = 10000
+MAX_HISTORY_ENTRIES = 40      # 20 user/model exchanges
+MAX_HISTORY_TOKENS = 32000    # rough estimate: ~4 chars per token
+SESSION_LOCK_TIMEOUT = 180    # seconds, must exceed GEMINI_DEADLINE; streams renew it
+
+redis = aioredis.Redis(
+    connection_pool=aioredis.ConnectionPool.from_url(REDIS_URL, max_connections=64, decode_responses=True)
+)
+
+@app.on_event("shutdown")
+async def close_redis():
+    await redis.aclose()
 
 # --- Pydantic models ---
 class StartSessionRequest(BaseModel):
     file_name: str
     full_file: str
 
+class SessionIdRequest(BaseModel):
+    session_id: str
+
 class SnippetRequest(BaseModel):
     session_id: str
     snippet: str
@@ -41,124 +117,565 @@ class SnippetRequest(BaseModel):
     programming_lang: str | None = None
 
 # --- Helper function for Gemini ---
-def ai_response(prompt_text: str, timeout: int = 40):
-    logging.info(f"Sending prompt to Gemini:\n{prompt_text[:500]}...")  # log first 500 chars
-    payload = {"contents": [{"parts": [{"text": prompt_text}]}]}
-    headers = {
-        "x-goog-api-key": API_KEY,
-        "Content-Type": "application/json"
-    }
+# Prompts arriving within BATCH_WINDOW of each other are sent to Gemini
+# together (up to BATCH_SIZE, one HTTP/2 stream each).
+BATCH_SIZE = 16
+BATCH_WINDOW = 0.02  # seconds
+
+gemini_queue = asyncio.Queue()
+batch_tasks = set()
+
+# Identical requests already on their way to Gemini, keyed by payload hash
+inflight: dict[bytes, asyncio.Future] = {}
+
+# Completed responses keyed by (response field, payload hash). Each entry holds
+# the text and the already-encoded {field: text} body, so a hit skips serialization.
+RESPONSE_CACHE = TTLCache(maxsize=4096, ttl=3600)
+
+# Rate limits and server-side errors are worth retrying; other 4xx are not
+RETRYABLE_STATUS = {429, 500, 502, 503, 504}
+
+def is_retryable(exc: BaseException):
+    if isinstance(exc, httpx.HTTPStatusError):
+        return exc.response.status_code in RETRYABLE_STATUS
+    return isinstance(exc, httpx.TransportError)
+
+class CircuitOpenError(Exception):
+    pass
+
+# After fail_max requests in a row fail (each after its retries), calls fail
+# immediately for reset_timeout seconds. The breaker then goes half-open: one
+# probe request is let through while the rest keep failing fast, and its
+# outcome decides whether the circuit closes or reopens.
+class CircuitBreaker:
+    def __init__(self, fail_max: int, reset_timeout: float):
+        self.fail_max = fail_max
+        self.reset_timeout = reset_timeout
+        self.failures = 0
+        self.opened_at = None
+        self.probing = False
+
+    # Returns True when this call is the half-open probe
+    def before_call(self):
+        if self.opened_at is None:
+            return False
+        if self.probing or time.monotonic() - self.opened_at < self.reset_timeout:
+            raise CircuitOpenError("Gemini API circuit is open, failing fast")
+        self.probing = True
+        return True
+
+    def record_success(self):
+        self.failures = 0
+        self.opened_at = None
+        self.probing = False
 
+    def record_failure(self):
+        self.failures += 1
+        if self.probing or self.failures >= self.fail_max:
+            self.opened_at = time.monotonic()
+        self.probing = False
+
+    def release_probe(self):
+        # The probe was cancelled without an outcome; let the next call try
+        self.probing = False
+
+breaker = CircuitBreaker(fail_max=10, reset_timeout=30)
+
+async def call_gemini(payload: bytes, timeout: int):
+    response = await client.post(GEMINI_URL, content=payload, headers=HEADERS, timeout=gemini_timeout(timeout))
+    response.raise_for_status()
+    data = orjson.loads(response.content)
+    return data["candidates"][0]["content"]["parts"][0]["text"]
+
+# Hard cap on one request including all retries and backoff. Per-attempt
+# timeouts alone add up to ~250s worst case, longer than the session lock.
+GEMINI_DEADLINE = 150  # seconds
+
+async def retry_gemini(payload: bytes, timeout: int):
+    async for attempt in AsyncRetrying(
+        wait=wait_exponential_jitter(initial=1, max=30),
+        stop=stop_after_attempt(4),
+        retry=retry_if_exception(is_retryable),
+        reraise=True,
+    ):
+        with attempt:
+            return await call_gemini(payload, timeout)
+
+async def post_gemini(payload: bytes, timeout: int):
+    probe = breaker.before_call()
     try:
-        response = requests.post(GEMINI_API_URL, json=payload, headers=headers, timeout=timeout)
-        response.raise_for_status()
-        data = response.json()
-        return data["candidates"][0]["content"]["parts"][0]["text"]
+        text = await asyncio.wait_for(retry_gemini(payload, timeout), GEMINI_DEADLINE)
     except Exception as e:
-        logging.error(f"Error calling Gemini API: {str(e)}")
+        # Anything other than a retryable failure or a blown deadline means Gemini answered
+        if is_retryable(e) or isinstance(e, asyncio.TimeoutError):
+            breaker.record_failure()
+        else:
+            breaker.record_success()
+        raise
+    except BaseException:
+        if probe:
+            breaker.release_probe()
+        raise
+    breaker.record_success()
+    return text
+
+async def run_batch(batch: list):
+    results = await asyncio.gather(
+        *(post_gemini(payload, timeout) for payload, timeout, _ in batch),
+        return_exceptions=True,
+    )
+    for (_, _, fut), result in zip(batch, results):
+        if isinstance(result, BaseException):
+            fut.set_exception(result)
+        else:
+            fut.set_result(result)
+
+async def gemini_batcher():
+    loop = asyncio.get_running_loop()
+    while True:
+        batch = [await gemini_queue.get()]
+        deadline = loop.time() + BATCH_WINDOW
+        while len(batch) < BATCH_SIZE:
+            remaining = deadline - loop.time()
+            if remaining <= 0:
+                break
+            try:
+                batch.append(await asyncio.wait_for(gemini_queue.get(), remaining))
+            except asyncio.TimeoutError:
+                break
+
+        # Don't wait on the batch here, or the next one would queue behind it
+        task = asyncio.create_task(run_batch(batch))
+        batch_tasks.add(task)
+        task.add_done_callback(batch_tasks.discard)
+
+@app.on_event("startup")
+async def start_batcher():
+    app.state.batcher = asyncio.create_task(gemini_batcher())
+
+@app.on_event("shutdown")
+async def stop_batcher():
+    app.state.batcher.cancel()
+
+def turn(role: str, text: str):
+    return {"role": role, "parts": [{"text": text}]}
+
+# Conversation turns go in Gemini's native `contents` array and the file
+# context in `system_instruction`, so the stable prefix is identical every call
+def gemini_payload(contents: list, system: str | None = None):
+    payload = {"contents": contents}
+    if system:
+        payload["system_instruction"] = {"parts": [{"text": system}]}
+    return orjson.dumps(payload)
+
+# Payloads bigger than this (in bytes) are hashed on the default thread pool.
+# Only the hash is offloaded: blake2b releases the GIL on large inputs, while
+# orjson.dumps holds it, so encoding in a thread would not free the loop.
+# Measured here: hashing 64KB inline takes ~170us, a thread hop ~80us.
+HASH_OFFLOAD_THRESHOLD = 65536
+
+def payload_key(payload: bytes):
+    return hashlib.blake2b(payload, digest_size=16).digest()
+
+async def hash_payload(payload: bytes):
+    if len(payload) > HASH_OFFLOAD_THRESHOLD:
+        return await asyncio.get_running_loop().run_in_executor(None, payload_key, payload)
+    return payload_key(payload)
+
+def finish_inflight(key: bytes, fut: asyncio.Future):
+    inflight.pop(key, None)
+    # Waiters await a shield, so if they have all gone away nobody else
+    # retrieves the error; mark it retrieved so asyncio doesn't log it
+    if not fut.cancelled():
+        fut.exception()
+
+# Returns (text, body), body being the JSON-encoded {field: text} response
+async def ai_response(contents: list, field: str, timeout: int = 40, system: str | None = None):
+    # Only slice the prompt when INFO is actually enabled
+    if log.isEnabledFor(logging.INFO):
+        log.info("Sending prompt to Gemini:\n%s...", contents[-1]["parts"][0]["text"][:500])  # log first 500 chars
+
+    try:
+        payload = gemini_payload(contents, system)
+        key = await hash_payload(payload)
+        cached = RESPONSE_CACHE.get((field, key))
+        if cached is not None:
+            return cached
+
+        fut = inflight.get(key)
+        if fut is None:
+            fut = asyncio.get_running_loop().create_future()
+            inflight[key] = fut
+            fut.add_done_callback(lambda f: finish_inflight(key, f))
+            await gemini_queue.put((payload, timeout, fut))
+        # Shielded so one caller disconnecting doesn't cancel the shared call
+        text = await asyncio.shield(fut)
+        cached = RESPONSE_CACHE[(field, key)] = (text, orjson.dumps({field: text}))
+        return cached
+    except CircuitOpenError as e:
+        raise HTTPException(status_code=503, detail=str(e))
+    except asyncio.TimeoutError:
+        log.error("Gemini API call exceeded %ss deadline", GEMINI_DEADLINE)
+        raise HTTPException(status_code=504, detail="Gemini API did not answer in time")
+    except Exception as e:
+        log.error("Error calling Gemini API: %s", e)
         raise HTTPException(status_code=500, detail=str(e))
 
-# --- Endpoints ---
+def parse_delta(data: str):
+    chunk = orjson.loads(data)
+    parts = chunk.get("candidates", [{}])[0].get("content", {}).get("parts", [])
+    return "".join(p.get("text", "") for p in parts)
 
-@app.post("/start_session")
-def start_session(req: StartSessionRequest):
-    session_id = str(uuid.uuid4())
-    sessions[session_id] = {
-        "file_name": req.file_name,
-        "full_file": req.full_file,
-        "history": []
+# Yields text deltas as Gemini generates them. Streams skip the batch queue,
+# the response cache and retries, since the point is to get the first tokens
+# out early and a partial stream can't be replayed.
+async def ai_response_stream(contents: list, timeout: int = 60, system: str | None = None):
+    if log.isEnabledFor(logging.INFO):
+        log.info("Streaming prompt to Gemini:\n%s...", contents[-1]["parts"][0]["text"][:500])  # log first 500 chars
+    payload = gemini_payload(contents, system)
+
+    # Streams aren't retried, but they still go through the breaker: fail fast
+    # while it is open, and count the outcome once the status is known
+    probe = breaker.before_call()
+    recorded = False
+    try:
+        async with client.stream("POST", GEMINI_STREAM, content=payload, headers=HEADERS, timeout=gemini_timeout(timeout)) as response:
+            response.raise_for_status()
+            breaker.record_success()
+            recorded = True
+            async for line in response.aiter_lines():
+                if line.startswith("data: "):
+                    text = parse_delta(line[len("data: "):])
+                    if text:
+                        yield text
+    except Exception as e:
+        if not recorded:
+            if is_retryable(e):
+                breaker.record_failure()
+            else:
+                breaker.record_success()
+        raise
+    except BaseException:
+        if probe and not recorded:
+            breaker.release_probe()
+        raise
+
+# --- Session helpers ---
+# Queues the commands that mark a session as used on an open pipeline
+def touch_session(pipe, session_id: str):
+    key = f"session:{session_id}"
+    pipe.expire(key, SESSION_TTL)
+    pipe.expire(f"{key}:history", SESSION_TTL)
+    pipe.expire(f"{key}:assistant", SESSION_TTL)
+    pipe.zadd(SESSION_INDEX, {session_id: time.time()}, xx=True)
+
+async def evict_sessions():
+    stale = await redis.zrange(SESSION_INDEX, 0, -(MAX_SESSIONS + 1))
+    if not stale:
+        return
+    async with redis.pipeline(transaction=False) as pipe:
+        for session_id in stale:
+            key = f"session:{session_id}"
+            pipe.delete(key, f"{key}:history", f"{key}:assistant")
+        # ZREM by id, not by rank, so sessions added meanwhile aren't dropped
+        pipe.zrem(SESSION_INDEX, *stale)
+        await pipe.execute()
+    log.info("Evicted %d least recently used sessions", len(stale))
+
+async def load_session(session_id: str):
+    key = f"session:{session_id}"
+    async with redis.pipeline(transaction=False) as pipe:
+        pipe.hgetall(key)
+        pipe.lrange(f"{key}:history", 0, -1)
+        touch_session(pipe, session_id)
+        data, raw_history, *_ = await pipe.execute()
+    if not data:
+        return None
+
+    # Drop empty turns (and the user turn an empty reply answered), since
+    # Gemini rejects empty text parts
+    history = []
+    for h in map(orjson.loads, raw_history):
+        if not h["parts"][0]["text"]:
+            if h["role"] == "model" and history and history[-1]["role"] == "user":
+                history.pop()
+            continue
+        history.append(h)
+
+    # Keep only the newest entries that fit in the token budget
+    tokens = 0
+    start = len(history)
+    while start > 0:
+        tokens += len(history[start - 1]["parts"][0]["text"]) // 4
+        if tokens > MAX_HISTORY_TOKENS:
+            break
+        start -= 1
+    history = history[start:]
+    if history and history[0]["role"] == "model":
+        history = history[1:]  # keep the conversation starting on a user turn
+
+    full_file = data["full_file"]
+    return {
+        "file_name": data["file_name"],
+        "full_file": full_file,
+        "history": history,
     }
-    logging.info(f"Started session {session_id} for file {req.file_name}")
+
+# Held from reading the history to writing the new turn, so concurrent
+# requests on one session never build prompts from stale history
+async def acquire_session_lock(session_id: str):
+    lock = redis.lock(
+        f"session:{session_id}:lock",
+        timeout=SESSION_LOCK_TIMEOUT,
+        blocking_timeout=SESSION_LOCK_TIMEOUT,
+    )
+    if not await lock.acquire():
+        raise HTTPException(status_code=409, detail="Session is busy")
+    return lock
+
+async def release_session_lock(lock):
+    try:
+        await lock.release()
+    except LockError:
+        pass  # expired while held; it is no longer ours to release
+
+# Returns the new user turn's text, the full contents array to send and the
+# system instruction carrying the file
+def build_explain_request(session: dict, req: SnippetRequest):
+    # Build prompt with limit instruction
+    parts = []
+    if req.programming_lang:
+        parts.append(f"Programming language: {req.programming_lang}\n")
+    parts.append(f"Explain the following code snippet in context of the full file in concisely:\n{req.snippet}\n")
+    if req.question:
+        parts.append(f"Question: {req.question}\n")
+    user_text = "".join(parts)
+
+    # Previous turns are replayed as-is ahead of the new one
+    contents = session["history"] + [turn("user", user_text)]
+    return user_text, contents, f"Full file:\n{session['full_file']}\n"
+
+async def session_exists(session_id: str):
+    async with redis.pipeline(transaction=False) as pipe:
+        pipe.exists(f"session:{session_id}")
+        touch_session(pipe, session_id)
+        exists, *_ = await pipe.execute()
+    return bool(exists)
+
+async def add_turn(session_id: str, user_content: str, assistant_content: str):
+    key = f"session:{session_id}"
+    async with redis.pipeline(transaction=False) as pipe:
+        pipe.rpush(
+            f"{key}:history",
+            orjson.dumps(turn("user", user_content)),
+            orjson.dumps(turn("model", assistant_content)),
+        )
+        pipe.ltrim(f"{key}:history", -MAX_HISTORY_ENTRIES, -1)
+        pipe.expire(f"{key}:history", SESSION_TTL)
+        pipe.rpush(f"{key}:assistant", assistant_content)
+        pipe.ltrim(f"{key}:assistant", -MAX_HISTORY_ENTRIES // 2, -1)
+        pipe.expire(f"{key}:assistant", SESSION_TTL)
+        await pipe.execute()
+
+# --- Endpoints ---
+
+# The body carries the whole file, so it is parsed straight from bytes with
+# orjson instead of going through Pydantic; the model only documents it.
+@app.post(
+    "/start_session",
+    openapi_extra={
+        "requestBody": {
+            "required": True,
+            "content": {"application/json": {"schema": StartSessionRequest.model_json_schema()}},
+        }
+    },
+)
+async def start_session(request: Request):
+    try:
+        data = orjson.loads(await request.body())
+    except orjson.JSONDecodeError:
+        raise HTTPException(status_code=422, detail="Invalid JSON body")
+    if not isinstance(data, dict):
+        raise HTTPException(status_code=422, detail="Expected a JSON object")
+    file_name, full_file = data.get("file_name"), data.get("full_file")
+    if not isinstance(file_name, str) or not isinstance(full_file, str):
+        raise HTTPException(status_code=422, detail="file_name and full_file must be strings")
+
+    session_id = secrets.token_urlsafe(16)
+    key = f"session:{session_id}"
+    async with redis.pipeline(transaction=False) as pipe:
+        pipe.hset(key, mapping={"file_name": file_name, "full_file": full_file})
+        pipe.expire(key, SESSION_TTL)
+        pipe.zadd(SESSION_INDEX, {session_id: time.time()})
+        await pipe.execute()
+    await evict_sessions()
+    log.info("Started session %s for file %s", session_id, file_name)
     return {"session_id": session_id}
 
 @app.post("/explain")
-def explain(req: SnippetRequest):
-    if req.session_id not in sessions:
+async def explain(req: SnippetRequest):
+    lock = await acquire_session_lock(req.session_id)
+    try:
+        session = await load_session(req.session_id)
+        if session is None:
+            raise HTTPException(status_code=404, detail="Session not found")
+
+        user_text, contents, system = build_explain_request(session, req)
+        explanation, body = await ai_response(contents, "explanation", system=system)
+
+        # Store in session
+        await add_turn(req.session_id, user_text, explanation)
+    finally:
+        await release_session_lock(lock)
+
+    return Response(content=body, media_type="application/json")
+
+# Deltas are buffered and flushed at most this often, so the client gets
+# a few larger SSE frames instead of one per token
+STREAM_FLUSH_INTERVAL = 0.02  # seconds
+
+def sse_event(data: dict, event: str | None = None):
+    prefix = f"event: {event}\n" if event else ""
+    return f"{prefix}data: {orjson.dumps(data).decode()}\n\n"
+
+@app.post("/explain_stream")
+async def explain_stream(req: SnippetRequest):
+    # Cheap existence check so a bad id still gets a real 404; everything
+    # else happens inside the generator, which takes and releases the lock
+    # itself so nothing is held if the body is never iterated
+    if not await redis.exists(f"session:{req.session_id}"):
         raise HTTPException(status_code=404, detail="Session not found")
 
-    session = sessions[req.session_id]
+    async def events():
+        # Headers are already sent by now, so failures are reported in-band
+        try:
+            lock = await acquire_session_lock(req.session_id)
+        except HTTPException as e:
+            yield sse_event({"detail": e.detail}, event="error")
+            return
 
-    # Build prompt with limit instruction
-    prompt = f"Explain the following code snippet in context of the full file in concisely:\n{req.snippet}\n"
-    if req.question:
-        prompt += f"Question: {req.question}\n"
-    if req.programming_lang:
-        prompt = f"Programming language: {req.programming_lang}\n" + prompt
-    prompt += f"\nFull file:\n{session['full_file']}\n\n"
+        loop = asyncio.get_running_loop()
+        try:
+            session = await load_session(req.session_id)
+            if session is None:
+                yield sse_event({"detail": "Session not found"}, event="error")
+                return
+            user_text, contents, system = build_explain_request(session, req)
 
-    # Include previous assistant messages
-    for h in session["history"]:
-        prompt += f"{h['role']}:\n{h['content']}\n"
+            full, pending = [], []
+            last_flush = last_refresh = loop.time()
+            try:
+                async for delta in ai_response_stream(contents, system=system):
+                    full.append(delta)
+                    pending.append(delta)
+                    if loop.time() - last_flush >= STREAM_FLUSH_INTERVAL:
+                        yield sse_event({"text": "".join(pending)})
+                        pending.clear()
+                        last_flush = loop.time()
+                    # The lock TTL doesn't bound how long a stream runs (the
+                    # read timeout resets on every chunk), so keep renewing it
+                    if loop.time() - last_refresh >= SESSION_LOCK_TIMEOUT / 2:
+                        await lock.reacquire()
+                        last_refresh = loop.time()
+                if pending:
+                    yield sse_event({"text": "".join(pending)})
+            except Exception as e:
+                log.error("Error streaming from Gemini API: %s", e)
+                yield sse_event({"detail": str(e)}, event="error")
+                return
 
-    explanation = ai_response(prompt)
+            # A SAFETY/RECITATION stop, or thinking using up the output budget,
+            # can end a stream with no text; storing that empty model turn
+            # would make Gemini reject every later replay of the history
+            reply = "".join(full)
+            if not reply:
+                yield sse_event({"detail": "Gemini returned no text"}, event="error")
+                return
 
-    # Store in session
-    session["history"].append({"role": "user", "content": req.snippet})
-    session["history"].append({"role": "assistant", "content": explanation})
+            await add_turn(req.session_id, user_text, reply)
+        finally:
+            await release_session_lock(lock)
+
+        yield sse_event({}, event="done")
 
-    logging.info(f"Returned explanation for session {req.session_id}")
-    return {"explanation": explanation}
+    return StreamingResponse(
+        events(),
+        media_type="text/event-stream",
+        # Ask proxies not to compress or buffer the stream either
+        headers={"Cache-Control": "no-cache, no-transform", "X-Accel-Buffering": "no"},
+    )
 
 @app.post("/fix")
-def fix(req: SnippetRequest):
-    if req.session_id not in sessions:
+async def fix(req: SnippetRequest):
+    # The fix prompt uses neither the file nor the history, so don't load them
+    if not await session_exists(req.session_id):
         raise HTTPException(status_code=404, detail="Session not found")
-    session = sessions[req.session_id]
     
     # Build prompt with only the snippet
-    prompt = f"Fix any bugs in the following code snippet:\n\n```\n{req.snippet}\n```\n\n"
-    
+    parts = []
     if req.programming_lang:
-        prompt = f"Programming language: {req.programming_lang}\n\n" + prompt
+        parts.append(f"Programming language: {req.programming_lang}\n\n")
+    parts.append(f"Fix any bugs in the following code snippet:\n\n```\n{req.snippet}\n```\n\n")
+    parts.append("Return only the corrected code snippet.")
+    prompt = "".join(parts)
     
-    prompt += "Return only the corrected code snippet."
+    fixed_code, body = await ai_response([turn("user", prompt)], "fixed_code", timeout=60)  # timeout 60s
     
-    try:
-        fixed_code = ai_response(prompt, timeout=60)  # timeout 60s
-    except Exception as e:
-        raise HTTPException(status_code=500, detail=f"Error: {str(e)}")
+    await add_turn(req.session_id, prompt, fixed_code)
     
-    session["history"].append({"role": "user", "content": req.snippet})
-    session["history"].append({"role": "assistant", "content": fixed_code})
-    
-    return {"fixed_code": fixed_code}
+    return Response(content=body, media_type="application/json")
 @app.post("/get_full_explanation")
-def get_full_explanation(session_id: str):
-    if session_id not in sessions:
+async def get_full_explanation(req: SessionIdRequest):
+    # Only the assistant list is needed, so skip loading the full file
+    key = f"session:{req.session_id}"
+    async with redis.pipeline(transaction=False) as pipe:
+        pipe.exists(key)
+        pipe.lrange(f"{key}:assistant", 0, -1)
+        touch_session(pipe, req.session_id)
+        exists, replies, *_ = await pipe.execute()
+    if not exists:
         raise HTTPException(status_code=404, detail="Session not found")
-    session = sessions[session_id]
-    full_exp = "\n\n".join([h["content"] for h in session["history"] if h["role"]=="assistant"])
-    return {"full_explanation": full_exp}
+    return {"full_explanation": "\n\n".join(replies)}
 
 @app.post("/method_completion")
-def method_completion(req: SnippetRequest):
-    if req.session_id not in sessions:
+async def method_completion(req: SnippetRequest):
+    session = await load_session(req.session_id)
+    if session is None:
         raise HTTPException(status_code=404, detail="Session not found")
 
-    session = sessions[req.session_id]
-    full_file = session["full_file"]
-
     # Build prompt for method completion
-    prompt = f"Complete the following method within the context of the code:\n{req.snippet}\n\nFull context:\n{full_file}\n"
+    parts = []
     if req.programming_lang:
-        prompt = f"Programming language: {req.programming_lang}\n" + prompt
-    prompt += "\nReturn only the completed method implementation."
+        parts.append(f"Programming language: {req.programming_lang}\n")
+    parts.append(f"Complete the following method within the context of the code:\n{req.snippet}\n")
+    parts.append("\nReturn only the completed method implementation.")
+    prompt = "".join(parts)
 
-    try:
-        completed_method = ai_response(prompt, timeout=60)
-    except Exception as e:
-        raise HTTPException(status_code=500, detail=f"Error: {str(e)}")
+    system = f"Full context:\n{session['full_file']}\n"
+    completed_method, body = await ai_response([turn("user", prompt)], "completed_method", timeout=60, system=system)
 
     # Store in session
-    session["history"].append({"role": "user", "content": req.snippet})
-    session["history"].append({"role": "assistant", "content": completed_method})
+    await add_turn(req.session_id, prompt, completed_method)
 
-    return {"completed_method": completed_method}
+    return Response(content=body, media_type="application/json")
 
 
 # --- Run locally ---
 if __name__ == "__main__":
     import uvicorn
-    logging.info("Starting MCP server on http://127.0.0.1:8000")
-    uvicorn.run(app, host="127.0.0.1", port=8000)
-
+    log.info("Starting MCP server on http://127.0.0.1:8000")
+    # Multiple workers need the app as an import string; sessions are shared through Redis.
+    # "auto" picks uvloop and httptools when installed (uvicorn[standard]).
+    # Production equivalent:
+    #   uvicorn server:app --host 127.0.0.1 --port 8000 --loop uvloop --http httptools \
+    #       --workers $(nproc) --limit-concurrency 1000 --timeout-keep-alive 30
+    uvicorn.run(
+        f"{Path(__file__).stem}:app",
+        host="127.0.0.1",
+        port=8000,
+        loop="auto",
+        http="auto",
+        workers=os.cpu_count(),
+        limit_concurrency=1000,
+        timeout_keep_alive=30,
+    )